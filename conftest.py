@@ -13,6 +13,30 @@ import dask
 import pytest
 
 
+def pytest_addoption(parser):
+    parser.addoption("--runslow", action="store_true", default=False,
+                     help="also run tests marked as slow")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers",
+                            "slow: exhaustive parameter grid, only run with "
+                            "--runslow")
+    # registered by pytest-xdist, which is optional
+    config.addinivalue_line("markers",
+                            "xdist_group(name): run tests of the group in "
+                            "the same pytest-xdist worker")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--runslow"):
+        return
+    skip_slow = pytest.mark.skip(reason="need --runslow option to run")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip_slow)
+
+
 @pytest.fixture(scope="session", params=(1, 2))
 def client(tmpdir_factory, request):
     with tmpdir_factory.mktemp("dask_cluster").as_cwd():
@@ -30,16 +30,127 @@ from __future__ import absolute_import, division
 
 import numpy as np
 
-from MDAnalysis.lib.distances import capped_distance, calc_angles
+from MDAnalysis.lib.distances import capped_distance, calc_angles, calc_bonds
 
 import MDAnalysis as mda
 
 from .parallel import ParallelAnalysisBase
 
+try:
+    from numba import njit
+except ImportError:
+    HAS_NUMBA = False
+else:
+    HAS_NUMBA = True
+
+
+if HAS_NUMBA:
+    @njit(fastmath=True, cache=True)
+    def _d_h_a_cosine(donors, hydrogens, acceptors, d, a, box):
+        """Cosine of the D-H-A angle of donor `d` and acceptor `a`.
+
+        The angle is measured at the hydrogen ``hydrogens[d]`` that belongs to
+        the donor ``donors[d]``. `box` contains the lengths of an orthorhombic
+        box, or zeros if there is no box.
+
+        The positions are read in their own (usually single) precision
+        without copies, but the vectors are accumulated in double precision
+        so that the angles agree with
+        :func:`~MDAnalysis.lib.distances.calc_angles`.
+        """
+        dot = 0.0
+        h_d2 = 0.0
+        h_a2 = 0.0
+        for k in range(3):
+            h_d = np.float64(donors[d, k]) - hydrogens[d, k]
+            h_a = np.float64(acceptors[a, k]) - hydrogens[d, k]
+            if box[k] > 0:
+                # minimum image convention
+                h_d -= box[k] * np.floor(h_d / box[k] + 0.5)
+                h_a -= box[k] * np.floor(h_a / box[k] + 0.5)
+            dot += h_d * h_a
+            h_d2 += h_d * h_d
+            h_a2 += h_a * h_a
+        return dot / np.sqrt(h_d2 * h_a2)
+
+    @njit(fastmath=True, cache=True)
+    def _d_h_a_filter(donors, hydrogens, acceptors, pairs, box, cos_cutoff):
+        """Find the donor-acceptor `pairs` with D-H-A angles above the cutoff.
+
+        Compares the cosines of all pairs with `cos_cutoff`, the cosine of the
+        angle cutoff, and returns the indices into `pairs` and the D-H-A angles
+        (in degrees) of the hydrogen bonds, so that the whole filter runs in a
+        single compiled call. The kernel is serial because dask already runs
+        the blocks in parallel. See :func:`_d_h_a_cosine` for the other
+        arguments.
+        """
+        cos_angles = np.empty(pairs.shape[0])
+        for i in range(pairs.shape[0]):
+            cos_angles[i] = _d_h_a_cosine(donors, hydrogens, acceptors,
+                                          pairs[i, 0], pairs[i, 1], box)
+        indices = np.nonzero(cos_angles < cos_cutoff)[0]
+        cos_hbonds = np.minimum(np.maximum(cos_angles[indices], -1.), 1.)
+        return indices, np.degrees(np.arccos(cos_hbonds))
+
+
+def _d_h_a_cosines_numpy(donors, hydrogens, acceptors, box):
+    """NumPy version of :func:`_d_h_a_cosine` for gathered positions"""
+    h_d = donors.astype(np.float64) - hydrogens
+    h_a = acceptors.astype(np.float64) - hydrogens
+    periodic = box > 0
+    for v in (h_d, h_a):
+        # minimum image convention
+        v[:, periodic] -= box[periodic] * np.floor(
+            v[:, periodic] / box[periodic] + 0.5)
+    dot = np.einsum('ij,ij->i', h_d, h_a)
+    return dot / np.sqrt(np.einsum('ij,ij->i', h_d, h_d) *
+                         np.einsum('ij,ij->i', h_a, h_a))
+
+
+def _orthorhombic_box(box):
+    """Box lengths for :func:`_d_h_a_filter` or ``None`` if triclinic"""
+    if box is None or not np.any(box[:3]):
+        return np.zeros(3)
+    if np.all(box[3:] == 90.):
+        return box[:3].astype(np.float64)
+    return None
+
+
+#: record layout of :attr:`HydrogenBondAnalysis.hbonds`
+_HBOND_DTYPE = np.dtype([('frame', np.int32), ('donor_id', np.int32),
+                         ('hydrogen_id', np.int32), ('acceptor_id', np.int32),
+                         ('distance', np.float64), ('angle', np.float64)])
+
+
+class _HBondResults(list):
+    """Hydrogen bonds found in the frames of a single block.
+
+    Appending the per-frame arrays to a list avoids copying all previous
+    results for every frame (as :func:`numpy.append` does). NumPy sees the
+    list as the stacked array of all hydrogen bonds, so the block is only
+    concatenated once when it is converted with :func:`numpy.asarray`.
+    """
+
+    def __array__(self, dtype=None, copy=None):
+        # concatenating always creates a new array, so `copy` (NumPy >= 2)
+        # needs no handling
+        del copy
+        return np.asarray(np.concatenate(self), dtype=dtype)
+
 
 class HydrogenBondAnalysis(ParallelAnalysisBase):
     """
     Perform an analysis of hydrogen bonds in a Universe.
+
+    After :meth:`run`, the hydrogen bonds found are stored in :attr:`hbonds`,
+    a structured array with one record per hydrogen bond and the fields
+    ``frame``, ``donor_id``, ``hydrogen_id``, ``acceptor_id`` (integers),
+    ``distance`` (the D-A distance in Å) and ``angle`` (the D-H-A angle in
+    degrees).
+
+    If `numba <https://numba.pydata.org>`_ is installed, the D-H-A angles of
+    systems without a box or with an orthorhombic box are calculated with a
+    compiled kernel.
     """
 
     def __init__(self, universe, donors_sel=None, hydrogens_sel=None,
@@ -183,6 +294,7 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
         self.d_h_a_angle = d_h_a_angle_cutoff
         self.update_selections = update_selections
         self._positions = ag.positions
+        self._use_numba = HAS_NUMBA
 
     def guess_hydrogens(self, selection='all', max_mass=1.1, min_charge=0.3):
         """Guesses which hydrogen atoms should be used in the analysis.
@@ -229,12 +341,13 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
             )
         ]
 
-        hydrogens_list = np.unique(
-            [
-                '(resname {} and name {})'.format(r, p)
-                for r, p in zip(hydrogens_ag.resnames, hydrogens_ag.names)
-            ]
-        )
+        # only format the unique (resname, name) pairs instead of one string
+        # per atom
+        pairs = np.stack([hydrogens_ag.resnames, hydrogens_ag.names], axis=1)
+        pairs = np.unique(pairs.astype(str), axis=0)
+        hydrogens_list = [
+            '(resname {} and name {})'.format(r, p) for r, p in pairs
+        ]
 
         return " or ".join(hydrogens_list)
 
@@ -295,12 +408,13 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
             )
         )
         donors_ag = ag[ag.charges < max_charge]
-        donors_list = np.unique(
-            [
-                '(resname {} and name {})'.format(r, p)
-                for r, p in zip(donors_ag.resnames, donors_ag.names)
-            ]
-        )
+        # only format the unique (resname, name) pairs instead of one string
+        # per atom
+        pairs = np.stack([donors_ag.resnames, donors_ag.names], axis=1)
+        pairs = np.unique(pairs.astype(str), axis=0)
+        donors_list = [
+            '(resname {} and name {})'.format(r, p) for r, p in pairs
+        ]
 
         return " or ".join(donors_list)
 
@@ -340,12 +454,13 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
         u = self._universe()
         ag = u.select_atoms(selection)
         acceptors_ag = ag[ag.charges < max_charge]
-        acceptors_list = np.unique(
-            [
-                '(resname {} and name {})'.format(r, p)
-                for r, p in zip(acceptors_ag.resnames, acceptors_ag.names)
-            ]
-        )
+        # only format the unique (resname, name) pairs instead of one string
+        # per atom
+        pairs = np.stack([acceptors_ag.resnames, acceptors_ag.names], axis=1)
+        pairs = np.unique(pairs.astype(str), axis=0)
+        acceptors_list = [
+            '(resname {} and name {})'.format(r, p) for r, p in pairs
+        ]
 
         return " or ".join(acceptors_list)
 
@@ -374,7 +489,22 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
                     'distance cutoff can be used.')
 
             hydrogens = u.select_atoms(self.hydrogens_sel)
-            donors = sum(h.bonded_atoms[0] for h in hydrogens)
+            # The donor is the first bonded atom of each hydrogen. Look it up
+            # in the bonds of the hydrogens, sorted in the same order as
+            # Atom.bonds, instead of building an AtomGroup per hydrogen.
+            bonds = np.sort(hydrogens.bonds.to_indices(), axis=1)
+            bonds = bonds[np.lexsort((bonds[:, 1], bonds[:, 0]))]
+            atoms = bonds.ravel()
+            partners = bonds[:, ::-1].ravel()
+            order = np.argsort(atoms, kind='stable')
+            atoms, partners = atoms[order], partners[order]
+            first = np.searchsorted(atoms, hydrogens.indices)
+            if np.any(first == len(atoms)) or np.any(
+                    atoms[first % len(atoms)] != hydrogens.indices):
+                raise ValueError(
+                    'Cannot assign donor-hydrogen pairs via topology as not '
+                    'all hydrogens are bonded to another atom.')
+            donors = u.atoms[partners[first]]
 
         # Otherwise, use d_h_cutoff as a cutoff distance
         else:
@@ -386,6 +516,7 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
                 hydrogens.positions,
                 max_cutoff=self.d_h_cutoff,
                 box=u.dimensions,
+                method='nsgrid',
                 return_distances=False
             ).T
 
@@ -399,6 +530,8 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
         self.hbonds = []
         self.frames = np.arange(self.start, self.stop, self.step)
         self.timesteps = (self.frames*u.trajectory.dt) + u.trajectory[0].time
+        # angles above the cutoff have cosines below cos(cutoff)
+        self._cos_d_h_a = np.cos(np.deg2rad(self.d_h_a_angle))
         # Set atom selections if they have not been provided
         if not self.acceptors_sel:
             self.acceptors_sel = self.guess_acceptors()
@@ -411,66 +544,103 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
         self._acceptors_ids = acceptors.ids
         self._donors_ids = donors.ids
         self._hydrogens_ids = hydrogens.ids
+        # atom indices to gather the positions from each time step with when
+        # the selections are not updated
+        self._acceptors_indices = acceptors.indices
+        self._donors_indices = donors.indices
+        self._hydrogens_indices = hydrogens.indices
 
     def _single_frame(self, ts, atomgroups):
         u = atomgroups[0].universe
 
         box = ts.dimensions
 
-        # Update donor-hydrogen pairs if necessary
+        # Update donor-hydrogen pairs if necessary; only plain index and id
+        # arrays are used below, no AtomGroups
         if self.update_selections:
             acceptors = u.select_atoms(self.acceptors_sel)
             donors, hydrogens = self._get_dh_pairs(u)
+            donors_indices, donors_ids = donors.indices, donors.ids
+            hydrogens_indices, hydrogens_ids = hydrogens.indices, hydrogens.ids
+            acceptors_indices, acceptors_ids = acceptors.indices, acceptors.ids
         else:
-            acceptors = u.atoms[self._acceptors_ids]
-            donors = u.atoms[self._donors_ids]
-            hydrogens = u.atoms[self._hydrogens_ids]
+            donors_indices, donors_ids = self._donors_indices, self._donors_ids
+            hydrogens_indices = self._hydrogens_indices
+            hydrogens_ids = self._hydrogens_ids
+            acceptors_indices = self._acceptors_indices
+            acceptors_ids = self._acceptors_ids
+
+        # gather all positions once from the time step; everything below
+        # indexes these contiguous arrays
+        donor_pos = ts.positions[donors_indices]
+        hydrogen_pos = ts.positions[hydrogens_indices]
+        acceptor_pos = ts.positions[acceptors_indices]
+
         # find D and A within cutoff distance of one another
         # min_cutoff = 1.0 as an atom cannot form a hydrogen bond with itself
-        d_a_indices, d_a_distances = capped_distance(
-            donors.positions,
-            acceptors.positions,
+        # use a cell list (nsgrid) so that the search scales linearly with the
+        # number of atoms for the small cutoffs used here
+        d_a_indices = capped_distance(
+            donor_pos,
+            acceptor_pos,
             max_cutoff=self.d_a_cutoff,
             min_cutoff=1.0,
             box=box,
-            return_distances=True,
+            method='nsgrid',
+            return_distances=False,
         )
-
-        # Remove D-A pairs more than d_a_cutoff away from one another
-        tmp_donors = donors[d_a_indices.T[0]]
-        tmp_hydrogens = hydrogens[d_a_indices.T[0]]
-        tmp_acceptors = acceptors[d_a_indices.T[1]]
-
-        # Find D-H-A angles greater than d_h_a_angle_cutoff
-        d_h_a_angles = np.rad2deg(
-            calc_angles(
-                tmp_donors.positions,
-                tmp_hydrogens.positions,
-                tmp_acceptors.positions,
-                box=box
+        # sort the pairs by donor so that the donor and hydrogen positions
+        # below are gathered in ascending order instead of randomly
+        order = np.argsort(d_a_indices[:, 0], kind='stable')
+        d_a_indices = d_a_indices[order]
+
+        # Find D-H-A angles greater than d_h_a_angle_cutoff by comparing
+        # their cosines, so that arccos is only needed for the hydrogen bonds
+        ortho_box = _orthorhombic_box(box)
+        if ortho_box is not None and self._use_numba:
+            hbond_indices, hbond_angles = _d_h_a_filter(
+                donor_pos, hydrogen_pos, acceptor_pos, d_a_indices, ortho_box,
+                self._cos_d_h_a)
+        elif ortho_box is not None:
+            cos_angles = _d_h_a_cosines_numpy(
+                donor_pos[d_a_indices.T[0]],
+                hydrogen_pos[d_a_indices.T[0]],
+                acceptor_pos[d_a_indices.T[1]], ortho_box)
+            hbond_indices = np.where(cos_angles < self._cos_d_h_a)[0]
+            hbond_angles = np.rad2deg(
+                np.arccos(np.clip(cos_angles[hbond_indices], -1, 1)))
+        else:
+            # triclinic boxes need the full minimum image search
+            d_h_a_angles = np.rad2deg(
+                calc_angles(
+                    donor_pos[d_a_indices.T[0]],
+                    hydrogen_pos[d_a_indices.T[0]],
+                    acceptor_pos[d_a_indices.T[1]],
+                    box=box
+                )
             )
-        )
-        hbond_indices = np.where(d_h_a_angles > self.d_h_a_angle)[0]
+            hbond_indices = np.where(d_h_a_angles > self.d_h_a_angle)[0]
+            hbond_angles = d_h_a_angles[hbond_indices]
 
-        # Retrieve atoms, distances and angles of hydrogen bonds
-        hbond_donors = tmp_donors[hbond_indices]
-        hbond_hydrogens = tmp_hydrogens[hbond_indices]
-        hbond_acceptors = tmp_acceptors[hbond_indices]
-        hbond_distances = d_a_distances[hbond_indices]
-        hbond_angles = d_h_a_angles[hbond_indices]
+        # Retrieve atom ids and distances of hydrogen bonds; the D-A
+        # distances are only needed for the hydrogen bonds and are calculated
+        # in double precision (nsgrid only works in single precision)
+        hbond_pairs = d_a_indices[hbond_indices]
+        hbond_distances = calc_bonds(donor_pos[hbond_pairs[:, 0]],
+                                     acceptor_pos[hbond_pairs[:, 1]], box=box)
 
         # Store data on hydrogen bonds found at this frame
-        hbonds = [[], [], [], [], [], []]
-        hbonds[0].extend(np.full_like(hbond_donors, ts.frame))
-        hbonds[1].extend(hbond_donors.ids)
-        hbonds[2].extend(hbond_hydrogens.ids)
-        hbonds[3].extend(hbond_acceptors.ids)
-        hbonds[4].extend(hbond_distances)
-        hbonds[5].extend(hbond_angles)
-        return np.asarray(hbonds).T
+        hbonds = np.empty(hbond_indices.size, dtype=_HBOND_DTYPE)
+        hbonds['frame'] = ts.frame
+        hbonds['donor_id'] = donors_ids[hbond_pairs[:, 0]]
+        hbonds['hydrogen_id'] = hydrogens_ids[hbond_pairs[:, 0]]
+        hbonds['acceptor_id'] = acceptors_ids[hbond_pairs[:, 1]]
+        hbonds['distance'] = hbond_distances
+        hbonds['angle'] = hbond_angles
+        return hbonds
 
     def _conclude(self):
-        self.hbonds = np.vstack(self._results)
+        self.hbonds = np.concatenate(self._results)
 
     def count_by_time(self):
         """Counts the number of hydrogen bonds per timestep.
@@ -484,15 +654,8 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
              plot the number of hydrogen bonds over time.
         """
 
-        indices, tmp_counts = np.unique(self.hbonds[:, 0], axis=0,
-                                        return_counts=True)
-
-        indices -= self.start
-        indices /= self.step
-
-        counts = np.zeros_like(self.frames)
-        counts[indices.astype("int")] = tmp_counts
-        return counts
+        indices = (self.hbonds['frame'] - self.start) // self.step
+        return np.bincount(indices, minlength=self.frames.size)
 
     def count_by_type(self):
         """Counts the total number of each unique type of hydrogen bond.
@@ -511,15 +674,23 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
         bond.
         """
         u = self._universe()
-        d = u.atoms[self.hbonds[:, 1].astype("int")]
-        a = u.atoms[self.hbonds[:, 3].astype("int")]
-
-        tmp_hbonds = np.array([d.resnames, d.types, a.resnames, a.types],
-                              dtype=np.str).T
+        d = u.atoms[self.hbonds['donor_id']]
+        a = u.atoms[self.hbonds['acceptor_id']]
+
+        # fixed-width strings (as wide as the longest name) sort much faster
+        # in np.unique than Python objects; ASCII names are further encoded
+        # to byte strings (a quarter of the size of unicode) and only the
+        # unique types are decoded again
+        tmp_hbonds = np.stack([d.resnames, d.types, a.resnames, a.types],
+                              axis=1).astype('U')
+        try:
+            tmp_hbonds = tmp_hbonds.astype(bytes)
+        except UnicodeEncodeError:
+            pass
         hbond_type, type_counts = np.unique(tmp_hbonds, axis=0,
                                             return_counts=True)
         hbond_type_list = []
-        for hb_type, hb_count in zip(hbond_type, type_counts):
+        for hb_type, hb_count in zip(hbond_type.astype('U'), type_counts):
             hbond_type_list.append(
                 [":".join(hb_type[:2]), ":".join(hb_type[2:4]), hb_count])
 
@@ -543,12 +714,9 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
         hydrogen atom id and acceptor atom id in a hydrogen bond.
         """
 
-        u = self._universe()
-        d = u.atoms[self.hbonds[:, 1].astype("int")]
-        h = u.atoms[self.hbonds[:, 2].astype("int")]
-        a = u.atoms[self.hbonds[:, 3].astype("int")]
-
-        tmp_hbonds = np.array([d.ids, h.ids, a.ids]).T
+        tmp_hbonds = np.stack([self.hbonds['donor_id'],
+                               self.hbonds['hydrogen_id'],
+                               self.hbonds['acceptor_id']], axis=1)
         hbond_ids, ids_counts = np.unique(tmp_hbonds, axis=0,
                                           return_counts=True)
 
@@ -562,20 +730,27 @@ class HydrogenBondAnalysis(ParallelAnalysisBase):
 
     def _universe(self):
         # A Universe containing position information is needed for guessing
-        # donors and acceptors.
-        u = mda.Universe(self._top)
-        if not hasattr(u.atoms, 'positions'):
-            u.load_new(self._positions)
-        return u
+        # donors and acceptors. It is built only once per analysis and not
+        # shared with other analyses, which may load different positions.
+        if getattr(self, '_cached_u', None) is None:
+            u = mda.Universe(self._top)
+            if not hasattr(u.atoms, 'positions'):
+                u.load_new(self._positions)
+            self._cached_u = u
+        return self._cached_u
+
+    def __getstate__(self):
+        # the cached Universe is not sent to the dask workers; it is rebuilt
+        # when needed after unpickling
+        state = self.__dict__.copy()
+        state.pop('_cached_u', None)
+        return state
 
     @staticmethod
     def _reduce(res, result_single_frame):
-        """ Use numpy array append to combine results"""
-        if isinstance(res, list) and len(res) == 0:
-            # Convert res from an empty list to a numpy array
-            # which has the same shape as the single frame result
-            res = result_single_frame
-        else:
-            # Add two numpy arrays
-            res = np.append(res, result_single_frame, axis=0)
+        """ Collect results in a list that is stacked once per block"""
+        if not isinstance(res, _HBondResults):
+            # Convert res from the empty list passed for the first frame
+            res = _HBondResults(res)
+        res.append(result_single_frame)
         return res
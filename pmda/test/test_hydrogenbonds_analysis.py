@@ -24,14 +24,17 @@
 
 from __future__ import absolute_import, division
 
+import pickle
+
 import numpy as np
+import dask
 import MDAnalysis
-from pmda.hbond_analysis import HydrogenBondAnalysis
+from pmda.hbond_analysis import HydrogenBondAnalysis, _HBOND_DTYPE
 
 import pytest
 from numpy.testing import assert_allclose
 from numpy.testing import assert_array_almost_equal, assert_array_equal
-from MDAnalysisTests.datafiles import waterPSF, waterDCD, GRO
+from MDAnalysisTests.datafiles import waterPSF, waterDCD, GRO, PSF, DCD
 
 
 class TestHydrogenBondAnalysisTIP3P(object):
@@ -58,7 +61,9 @@ class TestHydrogenBondAnalysisTIP3P(object):
     @pytest.mark.parametrize("n_blocks", [1, 2, 3, 4, 8])
     def test_hbond_analysis(self, h, n_blocks):
         h.run(n_jobs=n_blocks, n_blocks=n_blocks)
-        assert len(np.unique(h.hbonds[:, 0])) == 10
+        assert h.hbonds.dtype.names == ('frame', 'donor_id', 'hydrogen_id',
+                                        'acceptor_id', 'distance', 'angle')
+        assert len(np.unique(h.hbonds['frame'])) == 10
         assert len(h.hbonds) == 32
 
         reference = {
@@ -66,11 +71,20 @@ class TestHydrogenBondAnalysisTIP3P(object):
             'angle': {'mean': 158.9038039, 'std': 12.0362826},
         }
 
-        assert_allclose(np.mean(h.hbonds[:, 4]),
+        assert_allclose(np.mean(h.hbonds['distance']),
                         reference['distance']['mean'])
-        assert_allclose(np.std(h.hbonds[:, 4]), reference['distance']['std'])
-        assert_allclose(np.mean(h.hbonds[:, 5]), reference['angle']['mean'])
-        assert_allclose(np.std(h.hbonds[:, 5]), reference['angle']['std'])
+        assert_allclose(np.std(h.hbonds['distance']),
+                        reference['distance']['std'])
+        assert_allclose(np.mean(h.hbonds['angle']), reference['angle']['mean'])
+        assert_allclose(np.std(h.hbonds['angle']), reference['angle']['std'])
+
+    def test_hbond_analysis_threads(self, h):
+        # all blocks call the (compiled) kernels concurrently from threads of
+        # the same process
+        with dask.config.set(scheduler='threads'):
+            h.run(n_jobs=8, n_blocks=8)
+        assert len(h.hbonds) == 32
+        assert_allclose(np.mean(h.hbonds['angle']), 158.9038039)
 
     @pytest.mark.parametrize("n_blocks", [1, 2, 3, 4, 8])
     def test_count_by_time(self, h, n_blocks):
@@ -107,6 +121,24 @@ class TestHydrogenBondAnalysisTIP3P(object):
         u = h._universe()
         assert_array_almost_equal(u.atoms.positions, ref)
 
+    def test_universe_cached(self, h):
+        u = h._universe()
+        assert h._universe() is u
+        # the cached Universe is not pickled
+        assert '_cached_u' not in pickle.loads(pickle.dumps(h)).__dict__
+
+
+class TestHydrogenBondAnalysisTIP3PNumPy(TestHydrogenBondAnalysisTIP3P):
+    """Same as :class:`TestHydrogenBondAnalysisTIP3P` but always uses the
+    NumPy code path to calculate the D-H-A angles, even if numba is installed.
+    """
+
+    @pytest.fixture(scope='class')
+    def h(self, universe):
+        h = HydrogenBondAnalysis(universe, **self.kwargs)
+        h._use_numba = False
+        return h
+
 
 class TestGuess_UseTopology(TestHydrogenBondAnalysisTIP3P):
     """Uses the same distance and cutoff hydrogen bond criteria as
@@ -212,7 +244,7 @@ class TestHydrogenBondAnalysisTIP3PStartStep(object):
     @pytest.mark.parametrize("n_blocks", [1, 2, 3, 4])
     def test_hbond_analysis(self, h, n_blocks):
         h.run(start=1, step=2, n_jobs=n_blocks, n_blocks=n_blocks)
-        assert len(np.unique(h.hbonds[:, 0])) == 5
+        assert len(np.unique(h.hbonds['frame'])) == 5
         assert len(h.hbonds) == 15
 
         reference = {
@@ -220,11 +252,12 @@ class TestHydrogenBondAnalysisTIP3PStartStep(object):
             'angle': {'mean': 157.07768079, 'std': 9.72636682},
         }
 
-        assert_allclose(np.mean(h.hbonds[:, 4]),
+        assert_allclose(np.mean(h.hbonds['distance']),
                         reference['distance']['mean'])
-        assert_allclose(np.std(h.hbonds[:, 4]), reference['distance']['std'])
-        assert_allclose(np.mean(h.hbonds[:, 5]), reference['angle']['mean'])
-        assert_allclose(np.std(h.hbonds[:, 5]), reference['angle']['std'])
+        assert_allclose(np.std(h.hbonds['distance']),
+                        reference['distance']['std'])
+        assert_allclose(np.mean(h.hbonds['angle']), reference['angle']['mean'])
+        assert_allclose(np.std(h.hbonds['angle']), reference['angle']['std'])
 
     @pytest.mark.parametrize("n_blocks", [1, 2, 3, 4])
     def test_count_by_time(self, h, n_blocks):
@@ -271,3 +304,47 @@ class TestNoBond_Topology(object):
         h = HydrogenBondAnalysis(universe, **self.kwargs)
         u = h._universe()
         assert_array_almost_equal(u.atoms.positions, ref)
+
+
+@pytest.mark.parametrize("hydrogens_sel", ['name H*',
+                                           'name H* and resid 1-3'])
+def test_dh_pairs_topology(hydrogens_sel):
+    u = MDAnalysis.Universe(PSF, DCD)
+    h = HydrogenBondAnalysis(u, hydrogens_sel=hydrogens_sel)
+    donors, hydrogens = h._get_dh_pairs(u)
+    ref = [atom.bonded_atoms[0].index for atom in hydrogens]
+    assert_array_equal(donors.indices, ref)
+
+
+@pytest.mark.parametrize("hydrogen", [1, 14])
+def test_dh_pairs_topology_unbonded(hydrogen):
+    # without its bonds, the first hydrogen is missing from the middle of
+    # the sorted bond list and the last one would be placed after its end
+    u = MDAnalysis.Universe(waterPSF, waterDCD)
+    u.delete_bonds(u.atoms[hydrogen].bonds)
+    h = HydrogenBondAnalysis(u, hydrogens_sel='name H1 H2')
+    with pytest.raises(ValueError, match="not all hydrogens are bonded"):
+        h._get_dh_pairs(u)
+
+
+def test_reduce():
+    frames = [np.full(n, i, dtype=_HBOND_DTYPE)
+              for i, n in enumerate((3, 0, 2))]
+    res = []
+    for frame in frames:
+        res = HydrogenBondAnalysis._reduce(res, frame)
+    assert_array_equal(np.asarray(res), np.concatenate(frames))
+
+
+def test_count_by_type_unicode(monkeypatch):
+    # names that cannot be encoded as ASCII are counted as unicode
+    u = MDAnalysis.Universe.empty(4, n_residues=2, atom_resindex=[0, 0, 1, 1])
+    u.add_TopologyAttr('resnames', [u'SOL', u'SÖL'])
+    u.add_TopologyAttr('types', [u'OW', u'HW', u'OW', u'ÖW'])
+    h = HydrogenBondAnalysis(MDAnalysis.Universe(waterPSF, waterDCD))
+    monkeypatch.setattr(h, '_universe', lambda: u)
+    h.hbonds = np.zeros(3, dtype=_HBOND_DTYPE)
+    h.hbonds['acceptor_id'] = [2, 3, 3]
+    counts = h.count_by_type()
+    assert_array_equal(counts, [[u'SOL:OW', u'SÖL:OW', u'1'],
+                                [u'SOL:OW', u'SÖL:ÖW', u'2']])
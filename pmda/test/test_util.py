@@ -8,16 +8,15 @@
 # Released under the GNU Public Licence, v2 or any higher version
 from __future__ import absolute_import
 
-from six.moves import range, zip
-
 import pytest
 
 import time
-import functools
 import numpy as np
-from numpy.testing import assert_almost_equal, assert_equal
+from numpy.testing import assert_allclose, assert_almost_equal, assert_equal
 
-from pmda.util import timeit, make_balanced_slices, fold_second_order_moments
+import pmda.util
+from pmda.util import (timeit, make_balanced_slices, sumofsquares,
+                       fold_second_order_moments)
 
 
 def test_timeit():
@@ -57,7 +56,7 @@ def test_make_balanced_slices_step1(n_frames, n_blocks, start, result, step=1):
 def _test_make_balanced_slices(n_blocks, start, stop, step, scale):
     _start = start if start is not None else 0
 
-    traj_frames = range(scale * stop)
+    traj_frames = np.arange(scale * stop)
     frames = traj_frames[start:stop:step]
     n_frames = len(frames)
 
@@ -70,16 +69,11 @@ def _test_make_balanced_slices(n_blocks, start, stop, step, scale):
         # assemble frames again by blocks and show that we have all
         # the original frames; get the sizes of the blocks
 
-        block_frames = []
-        block_sizes = []
-        for bslice in slices:
-            bframes = traj_frames[bslice]
-            block_frames.extend(list(bframes))
-            block_sizes.append(len(bframes))
-        block_sizes = np.array(block_sizes)
+        block_frames = [traj_frames[bslice] for bslice in slices]
+        block_sizes = np.array([len(bframes) for bframes in block_frames])
 
         # check that we have all the frames accounted for
-        assert_equal(np.asarray(block_frames), np.asarray(frames))
+        assert np.array_equal(np.concatenate(block_frames), frames)
 
         # check that the distribution is balanced
         assert np.all(block_sizes > 0)
@@ -92,12 +86,46 @@ def _test_make_balanced_slices(n_blocks, start, stop, step, scale):
                                           start=start, stop=stop, step=step)
 
 
+# (n_blocks, start, stop, step, scale): hand-picked cases from the full grid
+# of test_make_balanced_slices_full (only run with --runslow) covering single
+# and many blocks, as many blocks as frames, too many blocks (ValueError),
+# steps that do and do not divide the number of frames, and trajectories
+# longer than stop (scale 2); the cases (1, None, 11, None, 1) and
+# (2, None, 5, 6, 1) were added beyond the grid for start=None and step > stop
+MAKE_BALANCED_SLICES_CASES = [
+    (1, None, 11, None, 1), (1, 0, 11, 1, 1), (1, 0, 256, 7, 2),
+    (1, 10, 11, None, 2), (1, 10, 100, 5, 1),
+    (2, None, 5, 6, 1), (2, 0, 11, None, 1), (2, 1, 11, 2, 1),
+    (2, 1, 100, 3, 2), (2, 10, 11, 1, 1), (2, 10, 256, 7, 2),
+    (3, 0, 11, 3, 1), (3, 0, 11, 5, 2), (3, 1, 100, None, 2),
+    (3, 10, 256, 2, 1), (3, 10, 11, 7, 2),
+    (4, 0, 11, 3, 1), (4, 1, 11, 3, 2), (4, 0, 100, 7, 1),
+    (4, 10, 256, 5, 2),
+    (5, 0, 11, 2, 1), (5, 1, 11, 2, 2), (5, 0, 11, 3, 1),
+    (5, 1, 100, 1, 1), (5, 10, 100, 7, 2), (5, 10, 256, None, 1),
+    (7, 0, 11, None, 2), (7, 1, 11, 5, 1), (7, 0, 100, 3, 1),
+    (7, 10, 100, 2, 2), (7, 1, 256, 7, 1),
+    (10, 1, 11, None, 1), (10, 0, 11, 1, 2), (10, 1, 11, 1, 2),
+    (10, 0, 100, 7, 2), (10, 10, 100, 5, 1), (10, 1, 256, 3, 2),
+    (11, 0, 11, None, 1), (11, 1, 11, 1, 1), (11, 0, 11, 2, 2),
+    (11, 0, 100, 7, 1), (11, 10, 100, 5, 2), (11, 1, 256, None, 2),
+    (11, 10, 256, 2, 1),
+]
+
+
+@pytest.mark.parametrize('n_blocks,start,stop,step,scale',
+                         MAKE_BALANCED_SLICES_CASES)
+def test_make_balanced_slices(n_blocks, start, stop, step, scale):
+    return _test_make_balanced_slices(n_blocks, start, stop, step, scale)
+
+
+@pytest.mark.slow
 @pytest.mark.parametrize('n_blocks', [1, 2, 3, 4, 5, 7, 10, 11])
 @pytest.mark.parametrize('start', [0, 1, 10])
 @pytest.mark.parametrize('stop', [11, 100, 256])
 @pytest.mark.parametrize('step', [None, 1, 2, 3, 5, 7])
 @pytest.mark.parametrize('scale', [1, 2])
-def test_make_balanced_slices(n_blocks, start, stop, step, scale):
+def test_make_balanced_slices_full(n_blocks, start, stop, step, scale):
     return _test_make_balanced_slices(n_blocks, start, stop, step, scale)
 
 
@@ -130,84 +158,145 @@ def test_make_balanced_slices_ValueError(n_frames, n_blocks,
                              start=start, stop=stop, step=step)
 
 
-def sumofsquares(a):
+@pytest.mark.parametrize('use_numba', [
+    pytest.param(True, marks=pytest.mark.skipif(
+        not pmda.util.HAS_NUMBA, reason="numba not installed")), False])
+def test_sumofsquares(use_numba, monkeypatch):
+    monkeypatch.setattr(pmda.util, 'HAS_NUMBA', use_numba)
+    # tiles of 8 frames, so that the NumPy path reduces several tiles and a
+    # partial last one
+    monkeypatch.setattr(pmda.util, '_SUMOFSQUARES_TILE_BYTES', 1000)
+    a = np.random.random(size=(101, 10, 3)).astype(np.float32) + 10
+    dev = a - a.mean(axis=0, dtype=np.float64)
+    assert_almost_equal(sumofsquares(a), np.sum(dev**2, axis=0), decimal=10)
+
+
+def test_sumofsquares_empty():
+    assert_equal(sumofsquares(np.empty((0, 10, 3))), np.zeros((10, 3)))
+
+
+def _random_positions(pos):
+    """Fills `pos` with random positions in range [-100, 100]"""
+    # fixed seed so that failures can be reproduced; the random numbers are
+    # drawn in double precision, so fill in chunks to keep temporaries small
+    rng = np.random.RandomState(0)
+    for i in range(0, len(pos), 1000):
+        chunk = pos[i:i+1000]
+        values = rng.random_sample(chunk.shape)
+        values -= 0.5
+        values *= 200
+        chunk[...] = values
+    return pos
+
+
+def _reference_stats(pos):
+    """Function returning the number of frames, mean and sum of squares of the
+    first `n_frames` frames of `pos`; they are only calculated once per
+    `n_frames` for all tests
     """
-    Calculates the sum of squares
-
-    Parameters
-    ----------
-    a : array
-        `t x n x m` array where `ts` is an integer (number of elements in the
-        partition, e.g., the number of time frames), `n` is an integer (number
-        of atoms in the system), and `m` is the number of dimensions (3 in this
-        case).
-    Returns
-    -------
-    sos : array
-        `n x m` array of the sum of squares for 'n' atoms
+    cache = {}
+
+    def stats(n_frames):
+        if n_frames not in cache:
+            cache[n_frames] = (n_frames,
+                               pos[:n_frames].mean(axis=0, dtype=np.float64),
+                               sumofsquares(pos[:n_frames]))
+        return cache[n_frames]
+    return stats
+
+
+# The positions are stored in single precision (like coordinates in
+# MDAnalysis), which halves the memory of the fixtures; all reductions over
+# them accumulate in double precision. Each fixture is only as large as the
+# tests using it require.
+
+@pytest.fixture(scope="session")
+def pos_small():
+    """Generates array of 1000 frames of random positions"""
+    return _random_positions(np.empty((1000, 1000, 3), dtype=np.float32))
+
+
+@pytest.fixture(scope="session")
+def pos_large(tmp_path_factory):
+    """Generates array of 50000 frames of random positions
+
+    The array is memory-mapped from a temporary file, so that only the frames
+    used by the tests are paged in.
     """
-    dev = a - np.mean(a, axis=0, dtype="float64")
-    sos = np.sum(dev**2, axis=0, dtype="float64")
-    return sos
+    filename = str(tmp_path_factory.mktemp("util") / "pos.npy")
+    pos = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32,
+                                    shape=(50000, 1000, 3))
+    _random_positions(pos)
+    pos.flush()
+    del pos
+    return np.load(filename, mmap_mode='r')
 
 
-@pytest.fixture(scope="module")
-def pos():
-    """Generates array of random positions in range [-100, 100]"""
-    return 200*(np.random.random(size=(100000,
-                                       1000,
-                                       3)) - 0.5).astype("float64")
+@pytest.fixture(scope="session")
+def reference_stats_small(pos_small):
+    return _reference_stats(pos_small)
 
 
-@pytest.mark.parametrize('n_frames', [3, 4, 10, 19, 101, 331, 1000])
-@pytest.mark.parametrize('isplit',
-                         [1, -1] +
-                         ["rand{0:03d}".format(i) for i in range(10)])
-def test_second_order_moments(pos, n_frames, isplit):
-    pos = pos[:n_frames]
-    if str(isplit).startswith("rand"):
-        # generate random splitting point
-        isplit = np.random.randint(1, n_frames-1)
-    # split into two partitions
-    p1, p2 = pos[:isplit], pos[isplit:]
-    # create [t, mu, M] lists
-    S1 = [len(p1), p1.mean(axis=0), sumofsquares(p1)]
-    S2 = [len(p2), p2.mean(axis=0), sumofsquares(p2)]
-    # run lists through second_order_moments
-    result = fold_second_order_moments([S1, S2])
-    # compare result to calculations over entire pos array
-    assert result[0] == len(pos)
-    assert_almost_equal(result[1], pos.mean(axis=0))
-    assert_almost_equal(result[2], sumofsquares(pos))
+@pytest.fixture(scope="session")
+def reference_stats_large(pos_large):
+    return _reference_stats(pos_large)
 
 
+# With pytest-xdist, run the tests using the position fixtures in a single
+# worker (with "pytest -n auto --dist loadgroup") so that the fixtures are
+# only generated once instead of once per worker.
+@pytest.mark.xdist_group("pmda_pos")
+@pytest.mark.parametrize('n_frames', [3, 4, 10, 19, 101, 331, 1000])
+def test_second_order_moments(pos_small, reference_stats_small, n_frames):
+    pos = pos_small[:n_frames]
+    # calculations over entire pos array, shared by all splitting points
+    ref_frames, ref_mean, ref_sos = reference_stats_small(n_frames)
+    # split after the first and before the last frame, and at 10 random
+    # splitting points
+    for isplit in [1, -1] + list(np.random.randint(1, n_frames-1, size=10)):
+        # split into two partitions
+        p1, p2 = pos[:isplit], pos[isplit:]
+        # create [t, mu, M] lists
+        S1 = [len(p1), p1.mean(axis=0, dtype=np.float64), sumofsquares(p1)]
+        S2 = [len(p2), p2.mean(axis=0, dtype=np.float64), sumofsquares(p2)]
+        # run lists through second_order_moments
+        result = fold_second_order_moments([S1, S2])
+        # compare result to calculations over entire pos array
+        err_msg = "splitting point isplit={0}".format(isplit)
+        assert result[0] == ref_frames, err_msg
+        assert_allclose(result[1], ref_mean, rtol=0, atol=1.5e-7,
+                        err_msg=err_msg)
+        assert_allclose(result[2], ref_sos, rtol=0, atol=1.5e-7,
+                        err_msg=err_msg)
+
+
+@pytest.mark.xdist_group("pmda_pos")
 @pytest.mark.parametrize('n_frames', [1000, 10000, 50000])
 @pytest.mark.parametrize('n_blocks', [2, 3, 4, 5, 10, 100, 500])
-def test_fold_second_order_moments(pos, n_frames, n_blocks):
-    pos = pos[:n_frames]
-    # all possible indices, except first and last ones
-    indices = np.arange(1, n_frames-1)
-    # (need n_blocks-1 indices "between" blocks)
-    # shuffle indices, take the first n_block indices, and sort
-    np.random.shuffle(indices)
-    split_indices = list(np.sort(indices[:n_blocks-1]))
+def test_fold_second_order_moments(pos_large, reference_stats_large, n_frames,
+                                   n_blocks):
+    pos = pos_large[:n_frames]
+    # draw n_blocks-1 different indices "between" blocks from all possible
+    # indices, except first and last ones, and sort them
+    split_indices = np.sort(
+        np.random.choice(n_frames-2, size=n_blocks-1, replace=False) + 1)
     # create start and stop indices for slices
-    start_indices = [0] + split_indices
-    stop_indices = split_indices + [n_frames]
+    start_indices = np.concatenate(([0], split_indices))
+    stop_indices = np.append(split_indices, n_frames)
     # slice "trajectory" pos into random length blocks to test more than two
     # cases per iteration
     blocks = [pos[i:j] for i, j in zip(start_indices, stop_indices)]
-    S = [(len(block), block.mean(axis=0, dtype="float64"),
+    S = [(len(block), block.mean(axis=0, dtype=np.float64),
           sumofsquares(block)) for block in blocks]
     # combine block results using fold method
     results = fold_second_order_moments(S)
     # compare result to calculations over entire pos array
-    assert results[0] == len(pos)
+    ref_frames, ref_mean, ref_sos = reference_stats_large(n_frames)
+    assert results[0] == ref_frames
     # check that the mean of the original pos array is equal to the collected
     # mean array from reduce()
-    assert_almost_equal(results[1], pos.mean(axis=0))
+    assert_allclose(results[1], ref_mean, rtol=0, atol=1.5e-7)
     # check that the sum of square arrays are equal
-    # Note: 'decimal' was changed from the default '7' to '5' because the
-    # absolute error for large trajectory lengths (n_frames > 1e4) is not
-    # almost equal to 7 decimal places
-    assert_almost_equal(results[2], sumofsquares(pos), decimal=5)
+    # Note: 'atol' was increased from 1.5e-7 to 1.5e-5 because the absolute
+    # error for large trajectory lengths (n_frames > 1e4) is not below 1e-7
+    assert_allclose(results[2], ref_sos, rtol=0, atol=1.5e-5)
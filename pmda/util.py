@@ -22,6 +22,13 @@ import functools
 
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError:
+    HAS_NUMBA = False
+else:
+    HAS_NUMBA = True
+
 
 class timeit(object):
     """measure time spend in context
@@ -284,6 +291,92 @@ def second_order_moments(S1, S2):
     return S
 
 
+#: number of bytes of `a` reduced at once by :func:`sumofsquares` (so that
+#: both sums read them from the L2 cache)
+_SUMOFSQUARES_TILE_BYTES = 2**20
+
+#: number of values per thread in the compiled :func:`sumofsquares`
+_SUMOFSQUARES_CHUNK = 256
+
+if HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, nogil=True, cache=True)
+    def _sumofsquares_numba(a):
+        """Compiled :func:`sumofsquares` of the `t x (n*m)` array `a`
+
+        Each thread reduces a chunk of columns frame by frame, so that `a` is
+        read along its rows and the sums of the chunk stay in the L1 cache.
+        Both sums are calculated in a single pass over `a`.
+        """
+        t, n = a.shape
+        s1 = np.zeros(n)
+        s2 = np.zeros(n)
+        n_chunks = (n + _SUMOFSQUARES_CHUNK - 1) // _SUMOFSQUARES_CHUNK
+        for c in prange(n_chunks):  # pylint: disable=not-an-iterable
+            first = c * _SUMOFSQUARES_CHUNK
+            last = min(n, first + _SUMOFSQUARES_CHUNK)
+            for i in range(t):
+                for j in range(first, last):
+                    x = np.float64(a[i, j])
+                    s1[j] += x
+                    s2[j] += x * x
+        return s2 - s1 * s1 / t
+
+
+def sumofsquares(a):
+    r"""Calculates the sum of squares of the deviations from the mean.
+
+    The sums of squares are calculated from the sums :math:`\sum_{t} x_{t}`
+    and :math:`\sum_{t} x_{t}^{2}` (accumulated in double precision) as
+
+    .. math::
+
+        M_{2} = \sum_{t} x_{t}^{2} - \frac{1}{T}\Big(\sum_{t} x_{t}\Big)^{2},
+
+    so that no temporary arrays of the size of `a` are created. The sums are
+    accumulated over tiles of frames that fit into the cache. If `numba
+    <https://numba.pydata.org>`_ is installed, both sums are calculated in a
+    single pass over `a` with a compiled (and multi-threaded) kernel.
+
+    Parameters
+    ----------
+    a : array
+        `t x n x m` array where `t` is an integer (number of elements in the
+        partition, e.g., the number of time frames), `n` is an integer (number
+        of atoms in the system), and `m` is the number of dimensions (3 in this
+        case).
+
+    Returns
+    -------
+    sos : array
+        `n x m` array of the sum of squares for `n` atoms, which can be
+        combined with :func:`fold_second_order_moments`
+
+    Notes
+    -----
+    The difference of the sums loses precision if the mean is much larger
+    than the fluctuations around it; in double precision this only matters
+    for ratios far beyond those of atomic positions.
+
+
+    .. versionadded:: 0.4.0
+    """
+    if len(a) == 0:
+        return np.zeros(a.shape[1:])
+    if HAS_NUMBA:
+        return _sumofsquares_numba(
+            a.reshape(len(a), -1)).reshape(a.shape[1:])
+    # reduce `a` in tiles of frames so that the second sum reads the tile
+    # from the cache again instead of from memory
+    tile = max(1, _SUMOFSQUARES_TILE_BYTES // max(1, a[0].nbytes))
+    s1 = np.zeros(a.shape[1:])
+    s2 = np.zeros(a.shape[1:])
+    for i in range(0, len(a), tile):
+        chunk = a[i:i+tile]
+        s1 += np.sum(chunk, axis=0, dtype=np.float64)
+        s2 += np.einsum('tij,tij->ij', chunk, chunk, dtype=np.float64)
+    return s2 - s1**2/len(a)
+
+
 def fold_second_order_moments(*args):
     """Fold action for :func:`second_order_moments` calculation.
 